@@ -1,18 +1,47 @@
 #!/usr/bin/python
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import socket
 import subprocess
 import threading
 import time
 import logging
 import os
+import random
+import select
+import shutil
+import signal
 from pathlib import Path
 
+try:
+    # Optional: talk to obs-websocket directly instead of spawning obs-cmd
+    from websockets.exceptions import ConnectionClosed, WebSocketException
+    from websockets.sync.client import connect as websocket_connect
+except ImportError:
+    websocket_connect = None
+
 # --- Configuration ---
-OBS_FLATPAK_COMMAND = ["flatpak", "run", "com.obsproject.Studio", "--disable-shutdown-check"]
-OBS_CMD_CHECK_COMMAND = ["obs-cmd", "info"]
-OBS_CMD_TOGGLE_COMMAND = ["obs-cmd", "replay", "toggle"]
+# Resolve binaries once, so each call doesn't search PATH again (None if not installed)
+_FLATPAK = shutil.which("flatpak")
+_OBS_CMD = shutil.which("obs-cmd")
+
+OBS_FLATPAK_COMMAND = [_FLATPAK or "flatpak", "run", "com.obsproject.Studio", "--disable-shutdown-check"]
+OBS_CMD_CHECK_COMMAND = [_OBS_CMD or "obs-cmd", "info"]
+OBS_CMD_TOGGLE_COMMAND = [_OBS_CMD or "obs-cmd", "replay", "toggle"]
+
+OBS_WEBSOCKET_HOST = "127.0.0.1"
+OBS_WEBSOCKET_PORT = int(os.getenv("OBS_WEBSOCKET_PORT", "4455"))
+OBS_WEBSOCKET_PASSWORD = os.getenv("OBS_WEBSOCKET_PASSWORD")
 
 MAX_WAIT_TIME_SECONDS = 60
-CHECK_INTERVAL_SECONDS = 1
+INITIAL_WAIT_SECONDS = 3 # OBS never responds sooner than this, so don't probe before
+CHECK_INTERVAL_INITIAL_SECONDS = 0.25
+CHECK_INTERVAL_MAX_SECONDS = 4.0
+CHECK_INTERVAL_JITTER = 0.5 # Random +/- fraction applied to each retry delay
+PROBE_TIMEOUT_SECONDS = 2 # Overall budget for one obs-websocket readiness probe
 
 OBS_SENTINEL_PATH = Path.home() / ".var/app/com.obsproject.Studio/config/obs-studio/.sentinel"
 # ---------------------
@@ -27,8 +56,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 # --------------------
 
-# Global variable to store the OBS process
-obs_process = None
+# Set when the script is asked to stop (e.g. Ctrl+C) while waiting for OBS
+_stop = threading.Event()
 
 def clean_sentinel_files():
     """
@@ -38,56 +67,102 @@ def clean_sentinel_files():
     try:
         if OBS_SENTINEL_PATH.exists():
             logger.info(f"Check crash markers in: {OBS_SENTINEL_PATH}")
-            for item in OBS_SENTINEL_PATH.iterdir():
-                if item.is_file() and item.name.startswith("run_"):
-                    logger.info(f"Deleting old startup markers: {item.name}")
+            # No is_file() check, unlink fails on anything that isn't a file
+            for item in OBS_SENTINEL_PATH.glob("run_*"):
+                try:
                     item.unlink()
+                    logger.info(f"Deleted old startup marker: {item.name}")
+                except OSError as e:
+                    logger.debug(f"Could not delete {item.name}: {e}")
         else:
             logger.debug("Folder .sentinel not found, skipping deletion.")
     except Exception as e:
         logger.error(f"Error when deleting .sentinel: {e}")
 
-def run_obs_in_thread():
+class SpawnedProcess:
     """
-    Runs OBS Studio in a separate process.
-    This function is intended to be run in a separate thread.
+    Minimal Popen-like wrapper (pid, poll(), returncode) around a pid from os.posix_spawn.
     """
-    global obs_process
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                # Same as Popen (and os.waitstatus_to_exitcode, which needs Python 3.9)
+                if os.WIFSIGNALED(status):
+                    self.returncode = -os.WTERMSIG(status)
+                else:
+                    self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
 
+def start_obs():
+    """
+    Runs OBS Studio in a separate process.
+    Uses posix_spawn (vfork + exec in glibc) instead of fork, no pipes are needed for OBS.
+    OBS keeps running after this script exits.
+    Returns a SpawnedProcess, or None if OBS could not be started.
+    """
     clean_sentinel_files()
 
     logger.info(f"Attempting to start OBS Studio with: {' '.join(OBS_FLATPAK_COMMAND)}")
     try:
-        obs_process = subprocess.Popen(OBS_FLATPAK_COMMAND)
-        logger.info(f"OBS Studio process started with PID: {obs_process.pid}. It will continue running after this script exits.")
+        # Reset signals Python ignores (like Popen's restore_signals), OBS shouldn't inherit them
+        pid = os.posix_spawn(
+            OBS_FLATPAK_COMMAND[0],
+            OBS_FLATPAK_COMMAND,
+            os.environ,
+            setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+        )
+        process = SpawnedProcess(pid)
+        logger.info(f"OBS Studio process started with PID: {process.pid}. It will continue running after this script exits.")
+        return process
     except FileNotFoundError:
         logger.error("Error: 'flatpak' command not found. Is Flatpak installed and in your PATH?")
-        # obs_process will remain None, handled by main thread
     except Exception as e:
         logger.error(f"An error occurred while trying to start OBS: {e}")
-        # obs_process might be None or an invalid Popen object if an error occurred during Popen itself
+    return None
 
-def is_obs_responsive():
+def is_obs_responsive(strict=False):
+    """
+    Checks if OBS (via obs-websocket) is responsive by connecting to the websocket port.
+    With 'strict', runs a simple obs-cmd instead (slower, but does a full request).
+    """
+    if strict:
+        return is_obs_responsive_strict()
+    try:
+        with socket.create_connection((OBS_WEBSOCKET_HOST, OBS_WEBSOCKET_PORT), timeout=0.5):
+            pass
+        logger.debug(f"OBS websocket port {OBS_WEBSOCKET_HOST}:{OBS_WEBSOCKET_PORT} is accepting connections.")
+        return True
+    except OSError as e:
+        logger.debug(f"OBS websocket connection failed: {e}")
+        return False
+
+def is_obs_responsive_strict():
     """
     Checks if OBS (via obs-websocket) is responsive by running a simple obs-cmd.
     """
     try:
         # Use a short timeout for the check command itself
-        result = subprocess.run(
+        subprocess.run(
             OBS_CMD_CHECK_COMMAND,
             check=True,
-            capture_output=True,
+            stdout=subprocess.DEVNULL, # Only the exit code matters here
+            stderr=subprocess.PIPE,
             text=True,
             timeout=5
         )
-        logger.debug(f"OBS responsive check successful. Version: {result.stdout.strip()}")
+        logger.debug("OBS responsive check successful.")
         return True
     except FileNotFoundError:
         logger.error("Error: 'obs-cmd' not found. Please install it (yay -S obs-cmd) and ensure it's in your PATH.")
         return False # Treat as fatal for this check's purpose
     except subprocess.CalledProcessError as e:
         # This usually means obs-cmd connected but got an error, or obs-websocket is not ready.
-        logger.debug(f"obs-cmd check failed (CalledProcessError): {e.stderr.strip() if e.stderr else e.stdout.strip()}")
+        logger.debug(f"obs-cmd check failed (CalledProcessError): {e.stderr.strip() if e.stderr else 'no output'}")
         return False
     except subprocess.TimeoutExpired:
         logger.debug("obs-cmd check timed out.")
@@ -96,69 +171,149 @@ def is_obs_responsive():
         logger.warning(f"Unexpected error checking OBS responsiveness: {e}")
         return False
 
-def main():
-    logger.info("--- OBS Starter and Replay Toggler Script ---")
+class ExitWatcher:
+    """
+    Waits for a process to exit, using a pidfd registered with a poll object
+    so the wait wakes up as soon as the process exits.
+    Falls back to polling the process if pidfd is not supported (Linux < 5.3 or Python < 3.9).
+    A signal wakeup pipe is registered too, so Ctrl+C interrupts the wait immediately.
+    Must be created in the main thread. Call close() when done to release the fds.
+    """
+    def __init__(self, process):
+        self.process = process
+        self._poller = select.poll()
+        # Python's C signal handler writes to this pipe, which wakes up poll()
+        # (otherwise poll() is just restarted after the handler runs)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        self._poller.register(self._wakeup_r, select.POLLIN)
+        self._pidfd = None
+        try:
+            self._pidfd = os.pidfd_open(process.pid, 0)
+            self._poller.register(self._pidfd, select.POLLIN)
+        except (AttributeError, OSError) as e:
+            logger.debug(f"pidfd_open unavailable, falling back to polling: {e}")
 
-    # 1. Start OBS in a separate thread
-    logger.info("Creating thread to start OBS Studio.")
-    obs_thread = threading.Thread(target=run_obs_in_thread, name="OBSLauncherThread", daemon=True)
-    obs_thread.start()
-    logger.info("OBS launcher thread started.")
+    def wait(self, timeout):
+        """
+        Waits up to 'timeout' seconds for the process to exit.
+        Returns True if the process has exited.
+        Returns early if a signal (e.g. Ctrl+C) arrives.
+        """
+        self._poller.poll(timeout * 1000)
+        return self.process.poll() is not None # Also reaps the process and sets returncode
 
-    # Give it a moment to actually try and launch the process
-    time.sleep(2) # Allow Popen to be called and obs_process to be set (or fail)
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        for fd in (self._wakeup_r, self._wakeup_w, self._pidfd):
+            if fd is not None:
+                os.close(fd)
+        self._pidfd = None
 
-    if obs_process is None:
-        logger.error("OBS process object not created. This likely means 'flatpak' was not found or another critical error occurred in the OBS starting thread.")
-        logger.info("Script will exit.")
-        return
-    elif obs_process.poll() is not None: # Check if process already exited
-        logger.error(f"OBS process (PID: {obs_process.pid}) started but exited immediately with code {obs_process.returncode}. Check OBS logs or flatpak errors.")
-        logger.info("Script will exit.")
-        return
-    else:
-        logger.info(f"OBS process (PID: {obs_process.pid}) appears to be running.")
+def obs_request(ws, request_type, timeout=5):
+    """
+    Sends an obs-websocket v5 request over an identified session and waits up to 'timeout' seconds for its response.
+    Returns the response data (may be None), raises RuntimeError if OBS reports a failure.
+    """
+    deadline = time.monotonic() + timeout
+    request_id = f"{request_type}-{time.monotonic_ns()}"
+    ws.send(json.dumps({"op": 6, "d": {"requestType": request_type, "requestId": request_id}}))
+    while True:
+        message = json.loads(ws.recv(timeout=max(0, deadline - time.monotonic())))
+        # Skip events (op 5) and responses to other requests
+        if message.get("op") == 7 and message["d"].get("requestId") == request_id:
+            break
+    status = message["d"]["requestStatus"]
+    if not status.get("result"):
+        raise RuntimeError(f"{request_type} failed with code {status.get('code')}: {status.get('comment', 'no details')}")
+    return message["d"].get("responseData")
 
+# obs-websocket close code sent when the Identify authentication string is wrong
+OBS_WEBSOCKET_AUTHENTICATION_FAILED = 4009
 
-    # 2. Wait for OBS to become responsive
-    logger.info(f"Waiting for OBS (via obs-websocket) to become responsive (max {MAX_WAIT_TIME_SECONDS} seconds)...")
-    start_time = time.time()
-    obs_is_ready = False
-    while time.time() - start_time < MAX_WAIT_TIME_SECONDS:
-        logger.info("Checking OBS responsiveness...")
-        if is_obs_responsive():
-            logger.info("OBS is responsive!")
-            obs_is_ready = True
-            break
-        logger.info(f"OBS not yet responsive. Retrying in {CHECK_INTERVAL_SECONDS}s...")
-        time.sleep(CHECK_INTERVAL_SECONDS)
+class ObsAuthenticationError(Exception):
+    """
+    Raised when obs-websocket rejects us because of a missing or wrong password.
+    Retrying won't help, unlike other connection errors.
+    """
 
-        # Check if the OBS process itself has unexpectedly died during the wait
-        if obs_process and obs_process.poll() is not None:
-            logger.warning(f"OBS process (PID: {obs_process.pid}) seems to have terminated unexpectedly with code {obs_process.returncode} while waiting for responsiveness.")
-            obs_is_ready = False
-            break
+def open_obs_session(session_stack, timeout=PROBE_TIMEOUT_SECONDS):
+    """
+    Connects to obs-websocket and performs the Hello/Identify handshake.
+    Sends a GetVersion request to make sure OBS is actually handling requests.
+    The whole probe (connect, handshake and GetVersion) takes at most 'timeout' seconds.
+    On success the connection is entered into 'session_stack' (an ExitStack),
+    which closes it when the caller's 'with' block ends.
+    Returns the connected websocket, or None if OBS is not ready yet.
+    Raises ObsAuthenticationError if the password is missing or wrong.
+    """
+    deadline = time.monotonic() + timeout
+    remaining = lambda: max(0, deadline - time.monotonic())
+    try:
+        with contextlib.ExitStack() as probe_stack:
+            ws = probe_stack.enter_context(websocket_connect(f"ws://{OBS_WEBSOCKET_HOST}:{OBS_WEBSOCKET_PORT}", open_timeout=timeout))
+            hello = json.loads(ws.recv(timeout=remaining()))["d"]
+            identify = {"rpcVersion": 1, "eventSubscriptions": 0}
+            if "authentication" in hello:
+                if not OBS_WEBSOCKET_PASSWORD:
+                    raise ObsAuthenticationError("obs-websocket requires a password, set OBS_WEBSOCKET_PASSWORD.")
+                # See obs-websocket protocol: base64(sha256(base64(sha256(password + salt)) + challenge))
+                auth = hello["authentication"]
+                secret = base64.b64encode(hashlib.sha256((OBS_WEBSOCKET_PASSWORD + auth["salt"]).encode()).digest())
+                identify["authentication"] = base64.b64encode(hashlib.sha256(secret + auth["challenge"].encode()).digest()).decode()
+            ws.send(json.dumps({"op": 1, "d": identify}))
+            try:
+                json.loads(ws.recv(timeout=remaining())) # Identified (op 2), the server closes the connection on failure
+            except ConnectionClosed as e:
+                if e.rcvd is not None and e.rcvd.code == OBS_WEBSOCKET_AUTHENTICATION_FAILED:
+                    raise ObsAuthenticationError("obs-websocket authentication failed, check OBS_WEBSOCKET_PASSWORD.") from e
+                raise
+            version = obs_request(ws, "GetVersion", timeout=remaining())
+            logger.debug(f"OBS responsive check successful. Version: {version.get('obsVersion')}")
+            # Keep the connection open, hand it over to the caller's stack
+            session_stack.enter_context(probe_stack.pop_all())
+            return ws
+    except ObsAuthenticationError:
+        raise
+    except (OSError, WebSocketException) as e:
+        logger.debug(f"obs-websocket connection failed: {e}")
+    except Exception as e:
+        logger.warning(f"Unexpected error connecting to obs-websocket: {e}")
+    return None
 
-    if not obs_is_ready:
-        logger.error("OBS did not become responsive within the time limit.")
-        if obs_process and obs_process.poll() is None:
-            logger.warning("OBS process might still be starting or stuck. You may need to manage it manually.")
-        logger.info("Script will exit without toggling replay.")
-        return
+def toggle_replay_websocket(ws):
+    """
+    Toggles the replay buffer over an already identified obs-websocket session.
+    The session is closed by the ExitStack it was opened with.
+    """
+    logger.info("Attempting to toggle replay buffer via obs-websocket.")
+    try:
+        obs_request(ws, "ToggleReplayBuffer", timeout=10)
+        logger.info("Successfully sent 'ToggleReplayBuffer' request.")
+    except RuntimeError as e:
+        logger.error(f"Error toggling replay buffer: {e}")
+        logger.warning("  This could mean OBS isn't configured for replays, the replay buffer isn't active, or another obs-websocket issue.")
+    except (TimeoutError, WebSocketException) as e:
+        logger.error(f"obs-websocket connection failed while toggling replay: {e}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while toggling replay: {e}")
 
-    # 3. Run obs-cmd replay toggle
+def toggle_replay_obs_cmd():
+    """
+    Toggles the replay buffer by running obs-cmd.
+    """
     logger.info(f"Attempting to toggle replay buffer with command: {' '.join(OBS_CMD_TOGGLE_COMMAND)}")
     try:
         result = subprocess.run(
             OBS_CMD_TOGGLE_COMMAND,
             check=True,
-            capture_output=True,
+            stdout=subprocess.DEVNULL, # Nothing useful on success, keep only stderr for errors
+            stderr=subprocess.PIPE,
             text=True,
             timeout=10
         )
         logger.info("Successfully sent 'replay toggle' command.")
-        if result.stdout:
-            logger.info(f"obs-cmd output: {result.stdout.strip()}")
         if result.stderr: # Should be empty on success, but log if present
             logger.warning(f"obs-cmd errors (though command succeeded): {result.stderr.strip()}")
     except FileNotFoundError:
@@ -166,7 +321,6 @@ def main():
     except subprocess.CalledProcessError as e:
         logger.error(f"Error executing 'obs-cmd replay toggle':")
         logger.error(f"  Return code: {e.returncode}")
-        if e.stdout: logger.error(f"  Stdout: {e.stdout.strip()}")
         if e.stderr: logger.error(f"  Stderr: {e.stderr.strip()}")
         logger.warning("  This could mean OBS isn't configured for replays, the replay buffer isn't active, or another obs-websocket issue.")
     except subprocess.TimeoutExpired:
@@ -174,6 +328,121 @@ def main():
     except Exception as e:
         logger.error(f"An unexpected error occurred while toggling replay: {e}")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Starts OBS Studio and toggles the replay buffer once it is ready.")
+    parser.add_argument(
+        "--strict-check",
+        action="store_true",
+        help="check OBS responsiveness and toggle replay with obs-cmd instead of obs-websocket (for debugging)",
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logger.info("--- OBS Starter and Replay Toggler Script ---")
+
+    if _FLATPAK is None:
+        logger.error("Error: 'flatpak' command not found. Is Flatpak installed and in your PATH?")
+        logger.info("Script will exit.")
+        return
+    if websocket_connect is None:
+        logger.info("Python 'websockets' (>= 11) not available, using obs-cmd to talk to OBS.")
+    use_websocket = websocket_connect is not None and not args.strict_check
+    if not use_websocket and _OBS_CMD is None:
+        logger.error("Error: 'obs-cmd' not found. Please install it (yay -S obs-cmd) and ensure it's in your PATH.")
+        logger.info("Script will exit.")
+        return
+
+    # 1. Start OBS
+    obs_process = start_obs()
+
+    if obs_process is None:
+        logger.error("OBS process object not created. This likely means 'flatpak' was not found or another critical error occurred while starting OBS.")
+        logger.info("Script will exit.")
+        return
+    elif obs_process.poll() is not None: # Check if process already exited
+        logger.error(f"OBS process (PID: {obs_process.pid}) started but exited immediately with code {obs_process.returncode}. Check OBS logs or flatpak errors.")
+        logger.info("Script will exit.")
+        return
+    else:
+        logger.info(f"OBS process (PID: {obs_process.pid}) appears to be running.")
+
+
+    # The obs-websocket session (if any) stays open from the readiness check through the toggle
+    with contextlib.ExitStack() as session_stack:
+        # 2. Wait for OBS to become responsive
+        # Ctrl+C only sets '_stop' while waiting, so the wait loop can exit cleanly
+        previous_sigint_handler = signal.signal(signal.SIGINT, lambda *_: _stop.set())
+        exit_watcher = ExitWatcher(obs_process)
+        try:
+            logger.info(f"Waiting for OBS (via obs-websocket) to become responsive (max {MAX_WAIT_TIME_SECONDS} seconds)...")
+            start_time = time.time()
+            if exit_watcher.wait(INITIAL_WAIT_SECONDS):
+                logger.error(f"OBS process (PID: {obs_process.pid}) exited during startup with code {obs_process.returncode}. Check OBS logs or flatpak errors.")
+                logger.info("Script will exit without toggling replay.")
+                return
+            if _stop.is_set():
+                logger.info("Interrupted. Script will exit without toggling replay.")
+                return
+
+            obs_is_ready = False
+            obs_session = None
+            attempt = 0
+            while time.time() - start_time < MAX_WAIT_TIME_SECONDS:
+                logger.info("Checking OBS responsiveness...")
+                if use_websocket:
+                    # Don't let a slow probe run past the overall time limit
+                    probe_timeout = min(PROBE_TIMEOUT_SECONDS, MAX_WAIT_TIME_SECONDS - (time.time() - start_time))
+                    try:
+                        obs_session = open_obs_session(session_stack, timeout=max(0, probe_timeout))
+                    except ObsAuthenticationError as e:
+                        logger.error(f"Error: {e}")
+                        logger.info("Script will exit without toggling replay.")
+                        return
+                    obs_is_ready = obs_session is not None
+                else:
+                    obs_is_ready = is_obs_responsive(strict=args.strict_check)
+                if obs_is_ready:
+                    logger.info("OBS is responsive!")
+                    break
+                # Exponential backoff with jitter, never waiting past the overall time limit
+                delay = min(CHECK_INTERVAL_INITIAL_SECONDS * (2 ** attempt), CHECK_INTERVAL_MAX_SECONDS)
+                delay *= 1 + random.uniform(-CHECK_INTERVAL_JITTER, CHECK_INTERVAL_JITTER)
+                delay = max(0, min(delay, MAX_WAIT_TIME_SECONDS - (time.time() - start_time)))
+                attempt += 1
+                logger.info(f"OBS not yet responsive. Retrying in {delay:.2f}s...")
+
+                # Wait for the next check, waking up immediately if the OBS process dies
+                if exit_watcher.wait(delay):
+                    logger.warning(f"OBS process (PID: {obs_process.pid}) seems to have terminated unexpectedly with code {obs_process.returncode} while waiting for responsiveness.")
+                    obs_is_ready = False
+                    break
+
+                if _stop.is_set():
+                    logger.info("Interrupted. Script will exit without toggling replay.")
+                    return
+
+            if not obs_is_ready:
+                logger.error("OBS did not become responsive within the time limit.")
+                if obs_process and obs_process.poll() is None:
+                    logger.warning("OBS process might still be starting or stuck. You may need to manage it manually.")
+                logger.info("Script will exit without toggling replay.")
+                return
+
+            # A probe can block for a few seconds, Ctrl+C may have come in during the last one
+            if _stop.is_set():
+                logger.info("Interrupted. Script will exit without toggling replay.")
+                return
+        finally:
+            exit_watcher.close()
+            signal.signal(signal.SIGINT, previous_sigint_handler)
+
+        # 3. Toggle the replay buffer, reusing the websocket session if there is one
+        if obs_session is not None:
+            toggle_replay_websocket(obs_session)
+        else:
+            toggle_replay_obs_cmd()
+
     logger.info("--- Script finished ---")
     logger.info("OBS Studio (if started successfully) should still be running in the background.")
 